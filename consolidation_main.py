@@ -1,6 +1,14 @@
-import json
+import base64
 import datetime
+import heapq
+import itertools
+import os
 import sys
+import tempfile
+import threading
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+
 from google.api_core.exceptions import PreconditionFailed, NotFound
 
 # Import shared GCS resources and configuration
@@ -9,11 +17,226 @@ from gcs_utils import (
     storage_client,
     FRAGMENTS_PREFIX,
     PROCESSED_FRAGMENTS_PREFIX,
+    STAGING_PREFIX,
     MASTER_LOG_FILE_NAME,
+    MESSAGE_ID_FIELD,
+    loads_json,
+    dumps_json,
 )
 
 # Configuration for the consolidation logic
 MAX_LOG_SIZE_KB = 200
+# Fragment reads are latency-bound, so fan them out across a thread pool.
+MAX_DOWNLOAD_WORKERS = 32
+# Fragments are listed page by page so reads can start before the listing finishes.
+LIST_PAGE_SIZE = 1000
+# Upper bound on fragment groups read but not yet parsed, to cap memory on large backlogs.
+MAX_PENDING_READS = 2 * MAX_DOWNLOAD_WORKERS
+# The GCS JSON API accepts at most 100 calls per batch request.
+MAX_BATCH_SIZE = 100
+# A single GCS compose request accepts at most 32 source objects. This is also the
+# number of fragments read per GET, via one composed staging blob.
+MAX_COMPOSE_SOURCES = 32
+
+# --- Local Fragment Cache ---
+# Raw fragment bytes are kept in the instance's RAM-backed /tmp, keyed by name and
+# generation. If a run fails after reading (e.g. the master log write), the retry
+# reads the same fragments from here instead of from GCS. /tmp counts against the
+# function's memory (256MiB by default), so the cap is enforced on every write.
+FRAGMENT_CACHE_DIR = os.path.join(tempfile.gettempdir(), "fragment_cache")
+MAX_FRAGMENT_CACHE_BYTES = 32 * 1024 * 1024
+# Bytes currently in the cache; reset by _evict_fragment_cache at the start of each run.
+_fragment_cache_bytes = 0
+_fragment_cache_lock = threading.Lock()
+
+# --- Warm-Instance Master Log Cache ---
+# The last master log this instance wrote successfully, as its generation, size and
+# parsed entries. With max_instances=1 a warm instance is normally the only writer, so
+# the next run can start from this instead of fetching the log again. A stale entry is
+# harmless: the conditional write fails and the cache is cleared.
+_master_log_cache = {}
+
+def _is_valid_entry(entry):
+    """A log entry must be a JSON object whose timestamp, if present, is a string."""
+    return isinstance(entry, dict) and isinstance(entry.get("timestamp", ""), str)
+
+def _ts_key(entry):
+    """Sort key for log entries; entries without a timestamp sort first."""
+    return entry.get("timestamp", "1970-01-01T00:00:00Z")
+
+def _drop_duplicate_entries(new_entries, existing_logs):
+    """
+    Pub/Sub delivers at least once, so the same message can reach several fragments.
+    Drops new entries whose message ID is already in the master log or earlier in this run.
+    Entries without a string ID (written before IDs were recorded, or edited by hand) are
+    always kept. Both lists must already have passed _is_valid_entry.
+    """
+    seen_ids = {entry[MESSAGE_ID_FIELD] for entry in existing_logs
+                if isinstance(entry.get(MESSAGE_ID_FIELD), str)}
+    unique_entries = []
+    for entry in new_entries:
+        message_id = entry.get(MESSAGE_ID_FIELD)
+        if isinstance(message_id, str):
+            if message_id in seen_ids: continue
+            seen_ids.add(message_id)
+        unique_entries.append(entry)
+    if len(unique_entries) != len(new_entries):
+        print(f"Dropped {len(new_entries) - len(unique_entries)} duplicate entries.")
+    return unique_entries
+
+def _chunks(items, size):
+    """Yields successive slices of at most `size` items."""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _compose(destination_name, source_blobs):
+    """
+    Concatenates any number of blobs server-side into `destination_name`. Compose accepts
+    at most 32 sources, so larger sets are chained by folding the destination back in.
+    """
+    destination = bucket.blob(destination_name)
+    destination.content_type = "application/x-ndjson"
+    destination.compose(source_blobs[:MAX_COMPOSE_SOURCES])
+    for chunk in _chunks(source_blobs[MAX_COMPOSE_SOURCES:], MAX_COMPOSE_SOURCES - 1):
+        destination.compose([destination] + chunk)
+    return destination
+
+def _fragment_cache_path(blob):
+    """Cache file for a fragment, keyed by name and generation so a stale copy is never used."""
+    encoded_name = base64.urlsafe_b64encode(blob.name.encode()).decode()
+    return os.path.join(FRAGMENT_CACHE_DIR, f"{encoded_name}.{blob.generation}")
+
+def _read_cached_fragment(blob):
+    """Returns the cached bytes of a fragment, or None on a cache miss."""
+    path = _fragment_cache_path(blob)
+    try:
+        with open(path, "rb") as f:
+            content = f.read()
+        os.utime(path) # Mark as recently used for LRU eviction.
+        return content
+    except OSError:
+        return None
+
+def _cache_fragment(blob, content):
+    """
+    Stores a fragment's bytes in the cache, unless that would exceed MAX_FRAGMENT_CACHE_BYTES.
+    Skipped or failed writes only cost a future re-download.
+    """
+    global _fragment_cache_bytes
+    with _fragment_cache_lock:
+        if _fragment_cache_bytes + len(content) > MAX_FRAGMENT_CACHE_BYTES:
+            return
+        _fragment_cache_bytes += len(content)
+
+    path = _fragment_cache_path(blob)
+    try:
+        os.makedirs(FRAGMENT_CACHE_DIR, exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(content)
+        os.replace(temp_path, path) # Atomic, so readers never see a partial file.
+    except OSError as e:
+        with _fragment_cache_lock:
+            _fragment_cache_bytes -= len(content)
+        print(f"Warning: Failed to cache fragment {blob.name}: {e}", file=sys.stderr)
+
+def _discard_cached_fragments(fragment_blobs):
+    """Removes cache entries for fragments that have been moved out of the fragments folder."""
+    for blob in fragment_blobs:
+        try:
+            os.remove(_fragment_cache_path(blob))
+        except OSError:
+            pass
+
+def _evict_fragment_cache():
+    """
+    Deletes the least recently used cache files until the cache fits in MAX_FRAGMENT_CACHE_BYTES,
+    and records the remaining size so this run's writes can respect the cap.
+    """
+    global _fragment_cache_bytes
+    try:
+        stats = [(entry.stat(), entry.path) for entry in os.scandir(FRAGMENT_CACHE_DIR) if entry.is_file()]
+    except OSError:
+        stats = []
+    entries = [(stat.st_mtime, stat.st_size, path) for stat, path in stats]
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= MAX_FRAGMENT_CACHE_BYTES:
+            break
+        try:
+            os.remove(path)
+            total_size -= size
+        except OSError:
+            pass
+    with _fragment_cache_lock:
+        _fragment_cache_bytes = total_size
+
+def _download_fragments(fragment_blobs):
+    """
+    Downloads a group of fragments with a single GET: they are composed server-side into a
+    staging blob, which is downloaded once and split back into per-fragment contents
+    using each source's listed size (compose pins the listed generations).
+    """
+    if len(fragment_blobs) == 1:
+        return [fragment_blobs[0].download_as_bytes()]
+
+    staging_blob = _compose(f"{STAGING_PREFIX}batch_{uuid.uuid4().hex}.ndjson", fragment_blobs)
+    try:
+        combined = staging_blob.download_as_bytes()
+    finally:
+        try:
+            staging_blob.delete()
+        except Exception as e:
+            print(f"Warning: Failed to delete staging blob {staging_blob.name}: {e}", file=sys.stderr)
+
+    contents = []
+    offset = 0
+    for blob in fragment_blobs:
+        contents.append(combined[offset:offset + blob.size])
+        offset += blob.size
+    if offset != len(combined):
+        raise ValueError(f"Composed size {len(combined)} does not match listed size {offset}")
+    return contents
+
+def _safe_read_fragments(fragment_blobs):
+    """
+    Reads a group of fragments, serving any already in the local cache from disk and
+    downloading the rest. Returns a (blob, content, error) tuple per fragment, so a
+    failure only skips this group's uncached fragments.
+    """
+    contents = {blob.name: _read_cached_fragment(blob) for blob in fragment_blobs}
+    missing = [blob for blob in fragment_blobs if contents[blob.name] is None]
+    error = None
+    if missing:
+        try:
+            for blob, content in zip(missing, _download_fragments(missing)):
+                contents[blob.name] = content
+                _cache_fragment(blob, content)
+        except Exception as e:
+            error = e
+
+    return [
+        (blob, contents[blob.name], None if contents[blob.name] is not None else error)
+        for blob in fragment_blobs
+    ]
+
+def _collect_fragment_entries(results, new_entries, valid_fragment_blobs):
+    """Parses the (blob, content, error) results of one read into the run's entry and fragment lists."""
+    for fragment, content, error in results:
+        try:
+            if error is not None:
+                raise error
+            # Fragments are NDJSON: one log entry per line. A fragment is only accepted
+            # if every line parses, so a partially corrupt fragment is left in place.
+            fragment_entries = [loads_json(line) for line in content.splitlines() if line.strip()]
+            valid_entries = [entry for entry in fragment_entries if _is_valid_entry(entry)]
+            if len(valid_entries) != len(fragment_entries):
+                # Entries that cannot be sorted would fail the whole run, so drop them here.
+                print(f"Warning: Dropped {len(fragment_entries) - len(valid_entries)} invalid entries from fragment {fragment.name}.", file=sys.stderr)
+            new_entries.extend(valid_entries)
+            valid_fragment_blobs.append(fragment)
+        except Exception as e:
+            print(f"Warning: Error processing fragment {fragment.name}: {e}. Skipping.", file=sys.stderr)
 
 def handle_consolidation(event, context):
     """
@@ -27,101 +250,158 @@ def handle_consolidation(event, context):
         # The error is logged for monitoring and alerting.
         return "Service misconfigured", 204
 
-    # 1. List all available fragments.
-    fragment_blobs = list(bucket.list_blobs(prefix=FRAGMENTS_PREFIX))
-    if not fragment_blobs:
+    # 1. Fetch the first page of fragments; the rest are streamed in step 3.
+    pages = bucket.list_blobs(prefix=FRAGMENTS_PREFIX, page_size=LIST_PAGE_SIZE).pages
+    first_page = list(next(pages, []))
+    if not first_page:
         print("No fragments to consolidate.")
         return "No fragments to consolidate.", 200
 
     # 2. Read the current master log, capturing its generation for a conditional write.
+    # Its metadata is fetched first: if it is over the size limit it is about to be
+    # archived wholesale, so its body never needs to be downloaded or parsed. On a warm
+    # instance both are skipped in favour of the log this instance last wrote.
     master_blob = bucket.blob(MASTER_LOG_FILE_NAME)
     all_logs = []
     generation = 0
+    rotate = False
     try:
-        content = master_blob.download_as_text()
-        generation = master_blob.generation
-        all_logs = json.loads(content)
+        if _master_log_cache:
+            generation = _master_log_cache["generation"]
+            rotate = (_master_log_cache["size"] / 1024) > MAX_LOG_SIZE_KB
+            if not rotate:
+                all_logs = _master_log_cache["logs"]
+        else:
+            master_blob.reload()
+            generation = master_blob.generation
+            rotate = (master_blob.size / 1024) > MAX_LOG_SIZE_KB
+            if not rotate:
+                all_logs = loads_json(master_blob.download_as_bytes(if_generation_match=generation))
         if not isinstance(all_logs, list):
-            print(f"Master log is not a list. It will be treated as corrupt.", file=sys.stderr)
+            print(f"Master log is not a list. It will be treated as corrupt and archived.", file=sys.stderr)
             all_logs = []
+            rotate = True # Archive the unusable generation instead of silently overwriting it.
     except NotFound:
         print("Master log not found. A new one will be created.")
-    except json.JSONDecodeError:
-        print("Could not parse master log. It will be overwritten.", file=sys.stderr)
+    except ValueError:
+        # The raw bytes are parsed without a separate text decode, so invalid UTF-8
+        # surfaces here as a parse error rather than as an unrecoverable failure.
+        print("Could not parse master log. It will be archived and replaced.", file=sys.stderr)
+        all_logs = []
+        rotate = True # Archive the unusable generation instead of silently overwriting it.
     except Exception as e:
         print(f"CRITICAL: Unrecoverable error reading master log: {e}", file=sys.stderr)
         raise  # Re-raise to have the function fail and trigger a potential retry.
 
+    # Entries that cannot be sorted would fail every run from here on, so drop them
+    # before the order check and merge, logging each one in full so it is not lost silently.
+    valid_logs = [entry for entry in all_logs if _is_valid_entry(entry)]
+    if len(valid_logs) != len(all_logs):
+        for entry in all_logs:
+            if not _is_valid_entry(entry):
+                print(f"Warning: Dropping invalid master log entry: {entry!r}", file=sys.stderr)
+        all_logs = valid_logs
+
     # 3. Process all fragments into a sorted list of new entries.
+    _evict_fragment_cache()
     new_entries = []
     valid_fragment_blobs = []
-    for fragment in fragment_blobs:
-        if fragment.name.endswith('/'): continue # Skip "directories"
-        try:
-            fragment_data = json.loads(fragment.download_as_text())
-            new_entries.append(fragment_data)
-            valid_fragment_blobs.append(fragment)
-        except Exception as e:
-            print(f"Warning: Error processing fragment {fragment.name}: {e}. Skipping.", file=sys.stderr)
+    with ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as executor:
+        # Submitting page by page lets workers read one page while the next is listed.
+        # Finished reads are parsed as soon as too many are in flight, so at most
+        # MAX_PENDING_READS groups of raw fragment bytes are held in memory at once.
+        pending = set()
+        for page in itertools.chain([first_page], pages):
+            page_blobs = [blob for blob in page if not blob.name.endswith('/')] # Skip "directories"
+            for group in _chunks(page_blobs, MAX_COMPOSE_SOURCES):
+                pending.add(executor.submit(_safe_read_fragments, group))
+                while len(pending) >= MAX_PENDING_READS:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        _collect_fragment_entries(future.result(), new_entries, valid_fragment_blobs)
+
+        for future in as_completed(pending):
+            _collect_fragment_entries(future.result(), new_entries, valid_fragment_blobs)
 
-    if not new_entries:
+    # Checked on fragments rather than entries, so a fragment holding only dropped
+    # entries is still moved out instead of being re-read on every run.
+    if not valid_fragment_blobs:
         print("No valid entries found in fragments.")
         return "No valid entries found in fragments.", 200
 
-    new_entries.sort(key=lambda x: x.get("timestamp", "1970-01-01T00:00:00Z"))
+    new_entries = _drop_duplicate_entries(new_entries, all_logs)
+    new_entries.sort(key=_ts_key)
 
-    # 4. Handle log rotation logic.
-    logs_to_archive = None
-    current_content_str = json.dumps(all_logs)
-    if (len(current_content_str.encode('utf-8')) / 1024) > MAX_LOG_SIZE_KB:
-        logs_to_archive = json.loads(current_content_str)
+    # 4. Handle log rotation logic. An oversized or unreadable log is archived with a server-side
+    # copy *before* it is overwritten, so no data passes through this function. The
+    # copy is pinned to the generation whose size triggered the rotation.
+    if rotate:
+        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d_%H-%M-%S')
+        try:
+            bucket.copy_blob(
+                master_blob, bucket, f"archive/master_log_{timestamp}.json",
+                source_generation=generation,
+            )
+        except Exception as e:
+            print(f"CRITICAL: Failed to archive master log: {e}", file=sys.stderr)
+            _master_log_cache.clear()
+            raise # Fail the function rather than overwrite a log that was never archived.
         logs_for_main_file = new_entries
-        generation = 0  # Writing a new file, so no existing generation to match.
     else:
-        logs_for_main_file = all_logs + new_entries
+        # Logs written before merging was introduced may be out of order, so verify the
+        # order in one linear pass and sort only if needed. A linear merge then keeps the
+        # combined log sorted, and every log written from here on stays sorted.
+        if any(_ts_key(a) > _ts_key(b) for a, b in itertools.pairwise(all_logs)):
+            all_logs = sorted(all_logs, key=_ts_key)
+        logs_for_main_file = list(heapq.merge(all_logs, new_entries, key=_ts_key))
 
-    # 5. Atomically write the updated master log.
+    # 5. Atomically write the updated master log. It is machine-consumed, so it is
+    # written compactly; indentation would only inflate every upload and download.
+    master_content = dumps_json(logs_for_main_file)
     try:
         master_blob.upload_from_string(
-            json.dumps(logs_for_main_file, indent=2),
+            master_content,
             content_type="application/json",
             if_generation_match=generation,
         )
     except PreconditionFailed:
         print("CRITICAL: Master log modified unexpectedly. This should not happen with max_instances=1. Aborting.", file=sys.stderr)
+        _master_log_cache.clear()
         raise # Fail the function to signal a critical, unexpected error.
     except Exception as e:
         print(f"CRITICAL: Failed to write master log: {e}", file=sys.stderr)
+        _master_log_cache.clear()
         raise # Fail the function
 
-    # 6. Archive old log if rotation occurred.
-    if logs_to_archive:
-        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d_%H-%M-%S')
-        archive_blob = bucket.blob(f"archive/master_log_{timestamp}.json")
-        try:
-            archive_blob.upload_from_string(json.dumps(logs_to_archive, indent=2))
-        except Exception as e:
-            print(f"Warning: Failed to upload archive file: {e}", file=sys.stderr)
+    # The upload response carries the new generation; remember it for the next run.
+    _master_log_cache.update(
+        generation=master_blob.generation,
+        size=len(master_content),
+        logs=logs_for_main_file,
+    )
 
-    # 7. Robust Cleanup: Move processed fragments to an archive folder.
+    # 6. Robust Cleanup: Move processed fragments to an archive folder.
     processed_count = 0
     try:
         # This is a non-transactional move, but it's more robust than simple deletion.
-        # First, copy all blobs to their new destination.
-        for blob in valid_fragment_blobs:
-            new_name = f"{PROCESSED_FRAGMENTS_PREFIX}{blob.name[len(FRAGMENTS_PREFIX):]}"
-            bucket.copy_blob(blob, bucket, new_name)
+        # First, concatenate all fragments server-side into a single NDJSON archive object:
+        # one compose per 32 fragments instead of one copy per fragment, with no data transfer.
+        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d_%H-%M-%S')
+        _compose(f"{PROCESSED_FRAGMENTS_PREFIX}batch_{timestamp}_{uuid.uuid4().hex}.ndjson", valid_fragment_blobs)
 
-        # After all copies succeed, delete the originals in a single batch operation.
-        with storage_client.batch():
-            for blob in valid_fragment_blobs:
-                blob.delete()
+        # After the compose succeeds, delete the originals, one batch request per chunk.
+        for chunk in _chunks(valid_fragment_blobs, MAX_BATCH_SIZE):
+            with storage_client.batch():
+                for blob in chunk:
+                    blob.delete()
 
+        _discard_cached_fragments(valid_fragment_blobs)
         processed_count = len(valid_fragment_blobs)
         print(f"Successfully processed and moved {processed_count} fragments.")
     except Exception as e:
         # This warning is critical. It means fragments were consolidated but not moved,
-        # so they will be re-processed on the next run, causing duplicates.
-        print(f"CRITICAL WARNING: Failed during fragment cleanup. Duplicates will occur on next run. Error: {e}", file=sys.stderr)
+        # so they will be re-processed on the next run. Entries with a message ID are
+        # dropped as duplicates then; older entries without one will be duplicated.
+        print(f"CRITICAL WARNING: Failed during fragment cleanup. Fragments will be re-processed on next run. Error: {e}", file=sys.stderr)
 
     return f"Consolidation complete. Processed {processed_count} fragments.", 200
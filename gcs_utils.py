@@ -1,6 +1,14 @@
+import json
 import os
+import re
 import sys
+
+import google.auth
+import orjson
+from google.auth.transport.requests import AuthorizedSession
 from google.cloud import storage
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # --- Configuration ---
 # The GCS bucket for storing logs. This must be set via environment variable.
@@ -9,7 +17,55 @@ MASTER_LOG_BUCKET = os.environ.get("MASTER_LOG_BUCKET")
 # Prefixes for organizing objects within the bucket.
 FRAGMENTS_PREFIX = "fragments/"
 PROCESSED_FRAGMENTS_PREFIX = "processed/"
+STAGING_PREFIX = "staging/"
 MASTER_LOG_FILE_NAME = "master_log.json"
+# Field added to every log entry at ingestion, used to drop Pub/Sub redeliveries.
+MESSAGE_ID_FIELD = "pubsub_message_id"
+
+# --- JSON Helpers ---
+# orjson is used for speed, but it is stricter than the stdlib json module that older logs
+# were written with: it rejects NaN/Infinity, silently turns integers beyond 64 bits into
+# floats, and cannot serialize either. These helpers fall back to the stdlib whenever
+# orjson would reject or alter the data, so no log entry is dropped or changed.
+_LONG_DIGIT_RUN = re.compile(rb"\d{19}") # Any integer orjson might not keep exact.
+
+class _NonFiniteFloat(float):
+    """NaN/Infinity parsed by the stdlib. orjson refuses to serialize it, forcing the stdlib path."""
+
+def loads_json(data):
+    """Parses JSON bytes with orjson, or with the stdlib if orjson would reject or alter them."""
+    if _LONG_DIGIT_RUN.search(data) is None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass # Possibly NaN/Infinity; the stdlib raises its own error if it is truly invalid.
+    return json.loads(data, parse_constant=_NonFiniteFloat)
+
+def dumps_json(obj):
+    """Serializes compactly to bytes with orjson, or with the stdlib for values orjson cannot represent."""
+    try:
+        return orjson.dumps(obj)
+    except orjson.JSONEncodeError:
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+# HTTP transport tuning. The pool is sized for the consolidation fan-out so that
+# concurrent requests reuse connections instead of queueing for one. The transport
+# only retries failed connections; retries on error statuses are left to the storage
+# library's DEFAULT_RETRY, which sees the real response and maps it to an exception.
+HTTP_POOL_CONNECTIONS = 32
+HTTP_POOL_MAXSIZE = 64
+HTTP_MAX_RETRIES = Retry(total=3, connect=3, read=0, status=0, backoff_factor=0.2, raise_on_status=False)
+
+def _build_http_session(credentials):
+    """Creates an authorized HTTP session with a sized connection pool and connection retries."""
+    session = AuthorizedSession(credentials)
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_CONNECTIONS,
+        pool_maxsize=HTTP_POOL_MAXSIZE,
+        max_retries=HTTP_MAX_RETRIES,
+    )
+    session.mount("https://", adapter)
+    return session
 
 # --- Global GCS Client Initialization ---
 # Initialize the GCS client and bucket globally to leverage connection pooling
@@ -19,7 +75,8 @@ bucket = None
 try:
     if not MASTER_LOG_BUCKET:
         raise ValueError("CRITICAL: MASTER_LOG_BUCKET environment variable not set.")
-    storage_client = storage.Client()
+    credentials, project = google.auth.default(scopes=storage.Client.SCOPE)
+    storage_client = storage.Client(project=project, _http=_build_http_session(credentials))
     bucket = storage_client.bucket(MASTER_LOG_BUCKET)
 except Exception as e:
     # If initialization fails, log a critical error. Subsequent service calls
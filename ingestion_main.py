@@ -1,74 +1,158 @@
+import asyncio
 import base64
-import json
 import uuid
-import datetime
 import sys
 import os
+from contextlib import asynccontextmanager
 
-from flask import Flask, request
-from google.api_core.exceptions import PreconditionFailed
+import orjson
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse
+from gcloud.aio.storage import Storage
 
-# Import shared GCS resources and configuration
-from gcs_utils import bucket, FRAGMENTS_PREFIX
+# Import shared GCS configuration
+from gcs_utils import MASTER_LOG_BUCKET, FRAGMENTS_PREFIX, MESSAGE_ID_FIELD, loads_json, dumps_json
 
-app = Flask(__name__)
+# Configuration for request coalescing: entries arriving within one window are
+# written together as a single NDJSON fragment.
+BATCH_WINDOW_SECONDS = 0.05
+MAX_BATCH_ENTRIES = 500
+# Fragment uploads are attempted once with a short deadline. Pub/Sub redelivers
+# anything answered with a 500, so it is the retry layer, not the storage client.
+UPLOAD_TIMEOUT_SECONDS = 2
 
-@app.route("/", methods=["POST"])
-def handle_log_ingestion():
+# --- Global Async GCS Client ---
+# A single aiohttp-backed client is shared by all requests for the lifetime of the
+# server, so one worker can keep many fragment uploads in flight at once.
+storage_client = None
+# Pending (message_id, log_entry, future) tuples awaiting the batch writer.
+entry_queue = None
+# Upload tasks that have been started but not yet finished.
+pending_writes = set()
+
+async def _write_batch(batch):
+    """
+    Writes a batch of entries as one fragment and resolves each entry's future with the outcome.
+    A redelivered message usually lands in a different batch, so duplicates cannot be caught
+    here; each entry carries its message ID and consolidation drops repeats. The random name
+    spreads concurrent writes evenly across the key space.
+    """
+    unique_entries = {}
+    for message_id, log_entry, _ in batch:
+        unique_entries.setdefault(message_id, log_entry)
+
+    fragment_name = f"{FRAGMENTS_PREFIX}{uuid.uuid4().hex}.ndjson"
+
+    error = None
+    try:
+        await storage_client.upload(
+            MASTER_LOG_BUCKET,
+            fragment_name,
+            b"".join(dumps_json(log_entry) + b"\n" for log_entry in unique_entries.values()),
+            content_type="application/x-ndjson",
+            force_resumable_upload=False, # Single-shot upload; resumable uploads retry internally
+            timeout=UPLOAD_TIMEOUT_SECONDS,
+        )
+    except Exception as e:
+        error = e
+
+    for _, _, future in batch:
+        if future.done(): continue # The request was cancelled while waiting.
+        if error is None:
+            future.set_result("Fragment written")
+        else:
+            future.set_exception(error)
+
+async def _batch_writer():
+    """Background task: drains the queue into batches bounded by time window and size."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await entry_queue.get()]
+        deadline = loop.time() + BATCH_WINDOW_SECONDS
+        while len(batch) < MAX_BATCH_ENTRIES:
+            remaining = deadline - loop.time()
+            if remaining <= 0: break
+            try:
+                batch.append(await asyncio.wait_for(entry_queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        # Upload in the background so the next window starts collecting immediately.
+        task = asyncio.create_task(_write_batch(batch))
+        pending_writes.add(task)
+        task.add_done_callback(pending_writes.discard)
+
+@asynccontextmanager
+async def lifespan(app):
+    global storage_client, entry_queue
+    async with Storage() as client:
+        storage_client = client
+        entry_queue = asyncio.Queue()
+        writer = asyncio.create_task(_batch_writer())
+        yield
+        writer.cancel()
+        await asyncio.gather(*pending_writes, return_exceptions=True)
+        storage_client = None
+
+app = FastAPI(lifespan=lifespan)
+
+@app.post("/")
+async def handle_log_ingestion(request: Request):
     """
     FAST PATH: Handles incoming Pub/Sub messages.
-    Writes each log entry as a unique, immutable fragment file to GCS.
-    This endpoint is designed to be fast, stateless, and idempotent.
+    Queues each log entry for the batch writer, which coalesces concurrent requests into
+    unique, immutable NDJSON fragment files in GCS. The response is only sent once the
+    entry's batch has been written, so Pub/Sub acknowledgement semantics are unchanged.
     """
-    if bucket is None:
-        print("CRITICAL: GCS bucket is not initialized. Service is misconfigured.", file=sys.stderr)
-        return "Service misconfigured", 500
+    if storage_client is None or not MASTER_LOG_BUCKET:
+        print("CRITICAL: GCS client is not initialized. Service is misconfigured.", file=sys.stderr)
+        return PlainTextResponse("Service misconfigured", status_code=500)
 
     # 1. Parse the incoming Pub/Sub message envelope
-    envelope = request.get_json(silent=True)
+    try:
+        envelope = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        envelope = None
     if not envelope or not isinstance(envelope, dict) or "message" not in envelope:
         print(f"Invalid Pub/Sub envelope format. Discarding message.", file=sys.stderr)
-        return "Invalid request format, acknowledged.", 200 # Acknowledge to prevent redelivery
+        return PlainTextResponse("Invalid request format, acknowledged.", status_code=200) # Acknowledge to prevent redelivery
 
     message = envelope['message']
     pubsub_data = message.get('data', '')
+    if not pubsub_data:
+        # Nothing to decode; acknowledge without touching the decoder or the batch writer.
+        return PlainTextResponse("Empty payload acknowledged", status_code=200)
 
     try:
-        decoded_data = base64.b64decode(pubsub_data).decode('utf-8')
-        log_entry = json.loads(decoded_data)
+        log_entry = loads_json(base64.b64decode(pubsub_data, validate=False))
     except Exception as e:
         print(f"Error decoding/parsing Pub/Sub data, discarding message: {e}", file=sys.stderr)
-        return "Malformed data, acknowledged.", 200 # Acknowledge to prevent redelivery
+        return PlainTextResponse("Malformed data, acknowledged.", status_code=200) # Acknowledge to prevent redelivery
 
-    # 2. Write the log entry as a unique fragment to GCS
-    try:
-        timestamp = log_entry.get("timestamp", datetime.datetime.now(datetime.timezone.utc).isoformat())
-        message_id = message.get('message_id', str(uuid.uuid4()))
+    # Consolidation sorts entries by their timestamp, so only accept objects whose
+    # timestamp, if present, is a string.
+    if not isinstance(log_entry, dict) or not isinstance(log_entry.get("timestamp", ""), str):
+        print(f"Log entry is not an object with a string timestamp, discarding message.", file=sys.stderr)
+        return PlainTextResponse("Malformed data, acknowledged.", status_code=200) # Acknowledge to prevent redelivery
 
-        safe_timestamp = timestamp.replace(':', '-')
-        fragment_name = f"{FRAGMENTS_PREFIX}{safe_timestamp}_{message_id}.json"
-        fragment_blob = bucket.blob(fragment_name)
+    # 2. Hand the log entry to the batch writer and wait for its fragment to be written
+    try:
+        # Pub/Sub always supplies an ID in production; only mint one when it is missing.
+        message_id = message.get('message_id') or str(uuid.uuid4())
+        log_entry[MESSAGE_ID_FIELD] = message_id
 
-        fragment_blob.upload_from_string(
-            json.dumps(log_entry),
-            content_type="application/json",
-            if_generation_match=0 # Atomically create; fails if fragment already exists
-        )
-    except PreconditionFailed:
-        # This is an expected race condition if Pub/Sub sends a duplicate message.
-        # The fragment already exists, so we acknowledge the message as successfully processed.
-        print(f"Duplicate message detected. Fragment {fragment_name} already exists.", file=sys.stderr)
-        return "Duplicate acknowledged", 200
+        future = asyncio.get_running_loop().create_future()
+        await entry_queue.put((message_id, log_entry, future))
+        result = await future
     except Exception as e:
-        # For any other GCS error, we MUST return a 500 status. This signals to
+        # For any GCS error, we MUST return a 500 status. This signals to
         # Pub/Sub that the message was not processed and should be redelivered later.
         print(f"CRITICAL: Failed to write log fragment to GCS: {e}", file=sys.stderr)
-        return "Internal Server Error", 500
+        return PlainTextResponse("Internal Server Error", status_code=500)
 
-    return "Fragment written", 200
+    return PlainTextResponse(result, status_code=200)
 
 if __name__ == "__main__":
-    # This block is for local development and is not used by Gunicorn in production.
+    # This block is for local development; production runs the app under the uvicorn CLI.
     # It requires the MASTER_LOG_BUCKET environment variable to be set.
-    print("Running with Flask development server. Use Gunicorn in production.", file=sys.stderr)
-    app.run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))